@@ -1,16 +1,23 @@
 import os
 import glob
+import argparse
 import itertools
+import warnings
 from datetime import datetime
+from dataclasses import dataclass
+from functools import lru_cache
 
 import numpy as np
 import scipy
-from scipy.fftpack.helper import next_fast_len
+import scipy.fft
+import scipy.signal
+from scipy.fft import next_fast_len
 import obspy
 import pyasdf
 import pandas as pd
 from obspy import read_inventory
 from obspy.signal.invsim import cosine_taper
+from obspy.signal.filter import bandpass
 
 import noise
 from mpi4py import MPI
@@ -25,7 +32,7 @@ Saves cross-correlation into an HDF5 file.
 
 def main(source,receiver,maxlag,downsamp_freq,
          freqmin,freqmax,XML,step=1800,cc_len=3600, method='cross_correlation',time_norm='running_mean',
-         to_whiten=True):
+         to_whiten=True,stack=False,max_std=50.,engine='numpy'):
 
     """
     Cross-correlates noise data from obspy stream.
@@ -53,91 +60,156 @@ def main(source,receiver,maxlag,downsamp_freq,
     :param step: time, in seconds, between success cross-correlation windows
     :type step: float
     :param step: length of noise data window, in seconds, to cross-correlate              
+    :type stack: bool
+    :param stack: return the mean of all windows' cross-correlations, as a 1-D array,
+                  instead of one cross-correlation per window
+    :type max_std: float
+    :param max_std: with stack=True, only stack windows where both traces' maximum
+                    amplitude is below max_std standard deviations, as corr_all does
+                    for unstacked windows. None stacks all windows.
+    :type engine: str
+    :param engine: 'numpy', or 'cupy' to run FFTs, whitening and correlation on the GPU
+    :type XML: str
+    :param XML: directory of StationXML files. Currently unused, instrument
+                responses are not removed.
 
     """
 
-    source = process_raw(source, downsamp_freq)
-    receiver = process_raw(receiver, downsamp_freq)
-    if len(source) == 0 or len(receiver) == 0:
-        raise ValueError('No traces in Stream')
-    source = source.merge(method=1, fill_value=0.)[0]
-    receiver = receiver.merge(method=1, fill_value=0.)[0]
-    source_stats, receiver_stats = source.stats, receiver.stats
-
-    # trim data to identical times
-    t1, t2 = source.stats.starttime, source.stats.endtime
-    t3, t4 = receiver.stats.starttime, receiver.stats.endtime
-    t1, t3 = nearest_step(t1, t3, step)
-    t2, t4 = nearest_step(t2, t4, step)
-    if t3 > t1:
-        t1 = t3
-    if t4 < t2:
-        t2 = t4
-    if t1 > t2:
-        raise ValueError('startime is larger than endtime')
+    result = next(main_one_to_many(source,[receiver],maxlag,downsamp_freq,freqmin,freqmax,XML,
+                                   step=step,cc_len=cc_len,method=method,time_norm=time_norm,
+                                   to_whiten=to_whiten,stack=stack,max_std=max_std,
+                                   engine=engine))
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def main_one_to_many(source,receivers,maxlag,downsamp_freq,
+         freqmin,freqmax,XML,step=1800,cc_len=3600, method='cross_correlation',time_norm='running_mean',
+         to_whiten=True,stack=False,max_std=50.,engine='numpy'):
+    """
+    Cross-correlates one source stream against many receiver streams.
+
+    The source is processed, windowed and whitened once and its spectra are
+    reused for every receiver. Both are trimmed to multiples of step since
+    the start of the day, and windows are matched on starttime, so each
+    receiver is only cross-correlated where it overlaps the source.
+
+    :type source: `~obspy.core.stream.Stream` object.
+    :param source: source waveforms
+    :type receivers: iterable
+    :param receivers: `~obspy.core.stream.Stream` objects, e.g. a generator
+                      reading them one at a time
+    :return: generator yielding, for each receiver in turn, the tuple returned
+             by `main`, or the exception raised while cross-correlating it.
+             With stack=True the times and parameters are those of the
+             stacked windows only. Errors in the source are raised.
+
+    See `main` for the remaining parameters.
+    """
 
+    source = merge_raw(source, downsamp_freq)
+    source_stats = source.stats
+    t1 = _round_to_step(source.stats.starttime, step)
+    t2 = _round_to_step(source.stats.endtime, step)
     source = source.trim(t1, t2, pad=True, fill_value=0.)
-    receiver = receiver.trim(t1, t2, pad=True, fill_value=0.)
-
-    t_len = np.arange(0, t2 - t1 - cc_len + step, step)
-    t_start = np.array([t1 + t for t in t_len])
-    t_end = np.array([t1 + t + cc_len for t in t_len])
-
-    # check no data at end of overlapping windows
-    t_ind = np.where(t_end <= t2)[0]
-    t_start = t_start[t_ind]
-    t_end = t_end[t_ind]
-
-    # get station inventory
-    if XML is not None:
-        inv1 = '.'.join([source.stats.network, source.stats.station, 'xml'])
-        inv2 = '.'.join([receiver.stats.network, receiver.stats.station, 'xml'])
-        inv1 = read_inventory(os.path.join(XML, inv1), format="STATIONXML")
-        inv2 = read_inventory(os.path.join(XML, inv2), format="STATIONXML")
-        inv1 = inv1.select(channel=source.stats.channel, starttime=t1, endtime=t2)
-        inv2 = inv2.select(channel=receiver.stats.channel, starttime=t1, endtime=t2)
-        inv1 = noise.pole_zero(inv1)
-        inv2 = noise.pole_zero(inv2)
-
-    # window waveforms
-    source_slice = obspy.Stream()
-    receiver_slice = obspy.Stream()
-    for win in source.slide(window_length=cc_len, step=step):
-        source_slice += win
-    del source
-    for win in receiver.slide(window_length=cc_len, step=step):
-        receiver_slice += win
-    del receiver
 
-    if len(source_slice) == 0 or len(receiver_slice) == 0:
+    delta = source.stats.delta
+    source_win, source_t = slice_windows(source, step, cc_len)
+    if len(source_win) == 0:
         raise ValueError('No traces in Stream')
 
-    # delete traces with starttimes that do not match
-    to_remove = []
-    for ii in range(len(source_slice)):
-        t1 = source_slice[ii].stats.starttime
-        t2 = receiver_slice[ii].stats.starttime
-        if t1 != t2:
-            to_remove.append(ii)
-    if len(to_remove) > 0:
-        for ii in to_remove[::-1]:
-            source_slice.remove(source_slice[ii])
-            receiver_slice.remove(receiver_slice[ii])
+    # whiten source once, along with its smoothed spectrum for deconv/coherence
+    Nfft = fft_len(source_win.shape[1], maxlag * downsamp_freq)
+    source_white, source_params = process_cc(source_win, delta, freqmin, freqmax, time_norm=time_norm,
+                                             to_whiten=to_whiten, Nfft=Nfft, engine=engine)
+    source_win = None
+    del source
+    xp = _array_module(engine)
+    source_smooth = None
+    if method in ['deconv','coherence']:
+        source_smooth = _smooth_box(xp, xp.abs(source_white), half_win=20)
+
+    for receiver in receivers:
+        try:
+            receiver = merge_raw(receiver, downsamp_freq)
+            receiver_stats = receiver.stats
+
+            # trim receiver to the part overlapping the source
+            t3 = max(t1, _round_to_step(receiver.stats.starttime, step))
+            t4 = min(t2, _round_to_step(receiver.stats.endtime, step))
+            if t3 > t4:
+                raise ValueError('startime is larger than endtime')
+            receiver = receiver.trim(t3, t4, pad=True, fill_value=0.)
+            receiver_win, receiver_t = slice_windows(receiver, step, cc_len)
+            del receiver
+
+            # keep only windows with matching starttimes
+            t_cc, s_ind, r_ind = np.intersect1d(source_t, receiver_t, return_indices=True)
+            if len(t_cc) == 0:
+                raise ValueError('No traces in Stream')
+            receiver_white, receiver_params = process_cc(receiver_win[r_ind], delta, freqmin, freqmax,
+                                                         time_norm=time_norm, to_whiten=to_whiten,
+                                                         Nfft=Nfft, engine=engine)
+            receiver_win = None
+
+            # leave windows with earthquakes or spurious amplitudes out of the stack
+            if stack and max_std is not None:
+                good = (source_params[s_ind,1] < max_std) & (receiver_params[:,1] < max_std)
+                if not np.any(good):
+                    raise ValueError('All windows above {} STD'.format(max_std))
+                t_cc, s_ind, receiver_params = t_cc[good], s_ind[good], receiver_params[good]
+                receiver_white = receiver_white[xp.asarray(np.flatnonzero(good))]
+
+            # cross-correlate using either cross-correlation, deconvolution, or cross-coherence
+            s_sel = xp.asarray(s_ind)
+            smooth1 = source_smooth[s_sel] if source_smooth is not None else None
+            corr = correlate(source_white[s_sel], receiver_white, maxlag * downsamp_freq,
+                             Nfft=Nfft, method=method, smooth1=smooth1, stack=stack, engine=engine)
+            if not np.any(corr):  # nothing cross-correlated
+                raise ValueError('No data cross-correlated')
+        except Exception as e:
+            yield e
+            continue
+
+        if stack:
+            corr = corr[0]
+        t_cc = np.vstack([t_cc, t_cc + cc_len]).T
+        yield corr, t_cc, source_stats, receiver_stats, source_params[s_ind], receiver_params
+
+
+def merge_raw(st, downsamp_freq):
+    """
+    Pre-process stream with `process_raw` and merge it into a single trace.
+    """
+    st = process_raw(st, downsamp_freq)
+    if len(st) == 0:
+        raise ValueError('No traces in Stream')
+    return st.merge(method=1, fill_value=0.)[0]
 
-    # apply one-bit normalization and whitening 
-    source_white, source_params = process_cc(source_slice, freqmin, freqmax, time_norm=time_norm)    
-    receiver_white, receiver_params = process_cc(receiver_slice, freqmin, freqmax, time_norm=time_norm)          
 
-    # cross-correlate using either cross-correlation, deconvolution, or cross-coherence 
-    corr = correlate(source_white, receiver_white, maxlag * downsamp_freq, method=method) 
-    source_slice, receiver_slice = None, None
+def slice_windows(tr, step, cc_len):
+    """
+    Cut trace into windows of cc_len seconds, starting every step seconds.
 
-    # stack cross-correlations
-    if not np.any(corr):  # nothing cross-correlated
-        raise ValueError('No data cross-correlated')
-    t_cc = np.vstack([t_start, t_end]).T
+    Windows are a read-only strided view of the trace data, not copies.
 
-    return corr, t_cc, source_stats, receiver_stats, source_params, receiver_params
+    :type tr: `~obspy.core.trace.Trace` object.
+    :param tr: merged trace
+    :type step: float
+    :param step: time, in seconds, between successive windows
+    :type cc_len: float
+    :param cc_len: length of each window, in seconds
+    :return: (W, cc_len * sampling_rate) array of windows and the starttime
+             of each window as a POSIX timestamp
+    """
+    samples_per_win = int(round(cc_len / tr.stats.delta))
+    step_samp = int(round(step / tr.stats.delta))
+    if tr.stats.npts < samples_per_win:
+        return np.empty((0, samples_per_win)), np.empty(0)
+    windows = np.lib.stride_tricks.sliding_window_view(tr.data, samples_per_win)[::step_samp]
+    starts = tr.stats.starttime.timestamp + np.arange(len(windows)) * step
+    return windows, starts
 
 
 def cross_corr_parameters(source, receiver, start_end_t, source_params,
@@ -150,7 +222,7 @@ def cross_corr_parameters(source, receiver, start_end_t, source_params,
     :type receiver: `~obspy.core.trace.Stats` object.
     :param receiver: Stats header from xcorr receiver station
     :type start_end_t: `~np.ndarray`
-    :param start_end_t: starttime, endtime of cross-correlation (UTCDateTime)
+    :param start_end_t: starttime, endtime of cross-correlation (POSIX timestamps)
     :type source_params: `~np.ndarray`
     :param source_params: max_mad,max_std,percent non-zero values of source trace
     :type receiver_params: `~np.ndarray`
@@ -165,8 +237,8 @@ def cross_corr_parameters(source, receiver, start_end_t, source_params,
     """
 
     # source and receiver locations in dict with lat, elevation_in_m, and lon
-    source_loc = locs.ix[source['network'] + '.' + source['station']]
-    receiver_loc = locs.ix[receiver['network'] + '.' + receiver['station']]
+    source_loc = locs.loc[source['network'] + '.' + source['station']]
+    receiver_loc = locs.loc[receiver['network'] + '.' + receiver['station']]
 
     # # get distance (in km), azimuth and back azimuth
     dist,azi,baz = noise.calc_distance(source_loc,receiver_loc) 
@@ -176,10 +248,8 @@ def cross_corr_parameters(source, receiver, start_end_t, source_params,
     receiver_mad,receiver_std,receiver_nonzero = receiver_params[:,0],\
                          receiver_params[:,1],receiver_params[:,2]
     
-    starttime = start_end_t[:,0] - obspy.UTCDateTime(1970,1,1)
-    starttime = starttime.astype('float')
-    endtime = start_end_t[:,1] - obspy.UTCDateTime(1970,1,1)
-    endtime = endtime.astype('float')
+    starttime = start_end_t[:,0].astype('float')
+    endtime = start_end_t[:,1].astype('float')
     source = stats_to_dict(source,'source')
     receiver = stats_to_dict(receiver,'receiver')
     # fill Correlation attribDict 
@@ -236,9 +306,7 @@ def process_raw(st,downsamp_freq):
     st = noise.check_sample(st)
 
     # check for traces with only zeros
-    for tr in st:
-        if tr.data.max() == 0:
-            st.remove(tr)
+    st.traces = [tr for tr in st if tr.data.max() != 0]
     if len(st) == 0:
         raise ValueError('No traces in Stream')
 
@@ -288,50 +356,48 @@ def clean_up(corr,sampling_rate,freqmin,freqmax):
     corr = bandpass(corr,freqmin,freqmax,sampling_rate,zerophase=True)
     return corr
 
-def process_cc(stream,freqmin,freqmax,percent=0.05,max_len=20.,time_norm='one_bit',
-               to_whiten=True):
+def process_cc(data,delta,freqmin,freqmax,percent=0.05,max_len=20.,time_norm='one_bit',
+               to_whiten=True,Nfft=None,engine='numpy'):
     """
 
     Pre-process for cross-correlation. 
 
     Checks ambient noise for earthquakesa and data gaps. 
     Performs one-bit normalization and spectral whitening.
+    Returns the positive-frequency half of the whitened spectrum (complex64).
+
+    :type data: `~numpy.ndarray`
+    :param data: (N, Nt) array of windows, e.g. from `slice_windows`. Not modified.
+    :type delta: float
+    :param delta: sampling interval of data, in seconds
+    :type engine: str
+    :param engine: 'numpy', or 'cupy' to whiten on the GPU. With 'cupy' the
+                   spectrum is returned as a cupy array, left on the device.
     """
     if time_norm in ['running_mean','one_bit']:
         normalize = True 
     else: 
         normalize = False
 
-    N = len(stream)
-    trace_mad = np.zeros(N)
-    trace_std = np.zeros(N)
-    nonzero = np.zeros(N)
-    stream.detrend(type='constant')
-    stream.detrend(type='linear')
-    stream.taper(max_percentage=percent,max_length=max_len)
-    stream.filter('bandpass',freqmin=freqmin,freqmax=freqmax,zerophase=True)
-    stream.detrend(type='constant')
-    scopy = stream.copy()
-    scopy = scopy.merge(method=1)[0]
-    all_mad = noise.mad(scopy.data)
-    all_std = np.std(scopy.data)
-    del scopy 
-    npts = []
-    for ii,trace in enumerate(stream):
-        # check for earthquakes and spurious amplitudes
-        trace_mad[ii] = np.max(np.abs(trace.data))/all_mad
-        trace_std[ii] = np.max(np.abs(trace.data))/all_std
-
-        # check if data has zeros/gaps
-        nonzero[ii] = np.count_nonzero(trace.data)/trace.stats.npts
-        npts.append(trace.stats.npts)
+    # detrend, taper and bandpass all windows at once, one pass over the matrix each
+    data = np.array(data, dtype=np.float64)
+    N, Nt = data.shape
+    data = scipy.signal.detrend(data, axis=1, type='linear', overwrite_data=True)
+    data *= hann_taper(Nt, delta, percent, max_len)
+    data = scipy.signal.sosfiltfilt(bandpass_sos(freqmin, freqmax, delta), data, axis=1)
+    data -= np.mean(data, axis=1, keepdims=True)
+
+    # check for earthquakes and spurious amplitudes
+    all_mad = noise.mad(data)
+    all_std = np.std(data)
+    max_abs = np.max(np.abs(data), axis=1)
+    trace_mad = max_abs / all_mad
+    trace_std = max_abs / all_std
+
+    # check if data has zeros/gaps
+    nonzero = np.count_nonzero(data, axis=1) / Nt
 
     # mask high amplitude phases, then whiten data
-    Nt = np.max(npts)
-    data = np.zeros([N,Nt])
-    for ii,trace in enumerate(stream):
-        data[ii,0:npts[ii]] = trace.data
-    
     if data.ndim == 1:
         axis = 0
     elif data.ndim == 2:
@@ -343,7 +409,12 @@ def process_cc(stream,freqmin,freqmax,percent=0.05,max_len=20.,time_norm='one_bi
         elif time_norm == 'running_mean':
             data = noise.running_abs_mean(data,int(1 / freqmin / 2))
 
-    FFTWhite = whiten(data,trace.stats.delta,freqmin,freqmax, to_whiten=to_whiten)
+    if Nfft is None:
+        Nfft = next_fast_len(int(Nt), real=True)
+    # whitened spectra are unit amplitude, single precision is enough
+    data = data.astype(np.float32)
+    plan = whiten_plan(int(Nfft),delta,freqmin,freqmax)
+    FFTWhite = whiten(data,plan,to_whiten=to_whiten,engine=engine)
 
     # if normalize:
     #     Nfft = next_fast_len(int(FFTWhite.shape[axis]))
@@ -358,6 +429,61 @@ def process_cc(stream,freqmin,freqmax,percent=0.05,max_len=20.,time_norm='one_bi
 
     return FFTWhite,np.vstack([trace_mad,trace_std,nonzero]).T
 
+@lru_cache(maxsize=32)
+def hann_taper(npts, delta, percent=0.05, max_len=20.):
+    """
+    Hann taper of both ends of a window, as applied by obspy's Trace.taper.
+
+    :type npts: int
+    :param npts: number of samples in the window
+    :type delta: float
+    :param delta: sampling interval, in seconds
+    :type percent: float
+    :param percent: maximum fraction of the window tapered at each end
+    :type max_len: float
+    :param max_len: maximum length, in seconds, tapered at each end
+    """
+    wlen = min(int(percent * npts), int(max_len / delta))
+    if 2 * wlen == npts:
+        sides = scipy.signal.get_window('hann', 2 * wlen, fftbins=False)
+    else:
+        sides = scipy.signal.get_window('hann', 2 * wlen + 1, fftbins=False)
+    taper = np.hstack((sides[:wlen], np.ones(npts - 2 * wlen),
+                       sides[len(sides) - wlen:]))
+    taper.flags.writeable = False
+    return taper
+
+
+@lru_cache(maxsize=32)
+def bandpass_sos(freqmin, freqmax, delta, corners=4):
+    """
+    Butterworth bandpass as second-order sections, for `scipy.signal.sosfiltfilt`.
+
+    Cached, so the returned array is shared between calls and must not be
+    modified. It is left writeable, as sosfiltfilt rejects read-only arrays.
+
+    :type freqmin: float
+    :param freqmin: lower corner frequency, in Hz
+    :type freqmax: float
+    :param freqmax: upper corner frequency, in Hz
+    :type delta: float
+    :param delta: sampling interval, in seconds
+    :type corners: int
+    :param corners: filter order
+
+    As with `obspy.signal.filter.bandpass`, a highpass is designed instead
+    if freqmax is at or above the Nyquist frequency.
+    """
+    fe = 0.5 / delta
+    if freqmax / fe - 1.0 > -1e-6:
+        warnings.warn("Selected high corner frequency ({}) is above Nyquist ({}). "
+                      "Applying a high-pass instead.".format(freqmax, fe))
+        return scipy.signal.butter(corners, freqmin, btype='highpass', fs=1. / delta,
+                                   output='sos')
+    sos = scipy.signal.butter(corners, [freqmin, freqmax], btype='band', fs=1. / delta,
+                              output='sos')
+    return sos
+
 def mseed_data(mseed_dir,starttime = None,endtime = None):
     """
     
@@ -379,109 +505,218 @@ def mseed_data(mseed_dir,starttime = None,endtime = None):
     loc = msplit[:,1]
     start = msplit[:,2]
     end = msplit[:,3]
+
+    # times in the file names sort and compare correctly as strings
     ind = np.argsort(start)
     start = start[ind]
     end = end[ind]
     mseed = np.array(mseed)[ind]
+    fmt = '%Y%m%dT%H%M%SZ'
+    keep = np.ones(len(mseed),dtype=bool)
+    if starttime is not None:
+        # file names have whole seconds, so start >= starttime iff start >= ceil(starttime)
+        keep &= start >= obspy.UTCDateTime(np.ceil(starttime.timestamp)).strftime(fmt)
+    if endtime is not None:
+        keep &= end <= endtime.strftime(fmt)
+    mseed,start,end = mseed[keep],start[keep],end[keep]
+
+    # only convert the files that are kept
     start = np.array([obspy.UTCDateTime(t) for t in start])
     end = np.array([obspy.UTCDateTime(t) for t in end])
-    if starttime is not None and endtime is not None:
-        ind = np.where((start >= starttime) & (end <= endtime))[0]
-        mseed,start,end = mseed[ind],start[ind],end[ind]
-    elif starttime is not None:
-        ind = np.where(start >= starttime)[0]
-        mseed,start,end = mseed[ind],start[ind],end[ind]
-    elif endtime is not None:
-        ind = np.where(end <= endtime)[0]
-        mseed,start,end = mseed[ind],start[ind],end[ind]
     return mseed,start,end 
 
-def correlate(fft1,fft2, maxlag, Nfft=None, method='cross_correlation'):
+def correlate(fft1,fft2, maxlag, Nfft=None, method='cross_correlation', smooth1=None, stack=False,
+              engine='numpy'):
     """This function takes ndimensional *data* array, computes the cross-correlation in the frequency domain
     and returns the cross-correlation function between [-*maxlag*:*maxlag*].
 
     :type fft1: :class:`numpy.ndarray`
-    :param fft1: This array contains the fft of each timeseries to be cross-correlated.
+    :param fft1: This array contains the real fft (positive frequencies) of each timeseries to be cross-correlated.
     :type maxlag: int
     :param maxlag: This number defines the number of samples (N=2*maxlag + 1) of the CCF that will be returned.
+    :type Nfft: int
+    :param Nfft: The number of points used to compute `fft1` and `fft2`.
+                 Defaults to the even length matching `fft1`.
+    :type smooth1: :class:`numpy.ndarray`
+    :param smooth1: Smoothed amplitude spectrum of `fft1`, for 'deconv' and 'coherence'.
+                    Pass it in to reuse it when correlating one source against many receivers.
+    :type stack: bool
+    :param stack: Average the cross-spectra of all windows before the inverse FFT and
+                  return a single (1, 2*maxlag + 1) stacked cross-correlation.
+    :type engine: str
+    :param engine: 'numpy', or 'cupy' to correlate on the GPU. Inputs may be numpy
+                   or cupy arrays, the result is always copied back to the host.
 
     :rtype: :class:`numpy.ndarray`
-    :returns: The cross-correlation function between [-maxlag:maxlag]
+    :returns: The cross-correlation function between [-maxlag:maxlag], float32
     """
-    # Speed up FFT by padding to optimal size for FFTPACK
-
     if fft1.ndim == 1:
         axis = 0
     elif fft1.ndim == 2:
         axis = 1
 
     if Nfft is None:
-        Nfft = next_fast_len(int(fft1.shape[axis]))
+        Nfft = 2 * (fft1.shape[axis] - 1)
+    plan = correlate_plan(int(Nfft), int(np.round(maxlag)))
+
+    xp = _array_module(engine)
+    if xp is not np:
+        fft1, fft2 = xp.asarray(fft1), xp.asarray(fft2)
+        if smooth1 is not None:
+            smooth1 = xp.asarray(smooth1)
+
+    # smoothed amplitude spectra, computed once each
+    if method in ['deconv','coherence']:
+        if smooth1 is None:
+            smooth1 = _smooth_box(xp, xp.abs(fft1), half_win=20)
+        smooth2 = _smooth_box(xp, xp.abs(fft2), half_win=20)
+        mean1 = xp.mean(smooth1,axis=axis,keepdims=True)
+
+    corr = (fft1 * xp.conj(fft2)).astype(np.complex64, copy=False)
+    if method == 'deconv':
+        corr /= smooth2 ** 2 + 0.01 * mean1
+    elif method == 'coherence':
+        corr /= smooth1 + 0.01 * mean1
+        corr /= smooth2 + 0.01 * xp.mean(smooth2,axis=axis,keepdims=True)
 
-    maxlag = np.round(maxlag)
+    # the FFT is linear, so stacking spectra needs one inverse FFT instead of one per window
+    if stack and axis == 1:
+        corr = xp.mean(corr,axis=0,keepdims=True)
 
-    Nt = fft1.shape[axis]
+    if xp is np:
+        corr = scipy.fft.irfft(corr, Nfft, axis=axis, workers=-1, overwrite_x=True)
+        return corr[...,plan.ind]
+    corr = xp.fft.irfft(corr, Nfft, axis=axis)
+    return xp.asnumpy(corr[...,xp.asarray(plan.ind)])
 
-    corr = fft1 * np.conj(fft2)
-    if method == 'deconv':
-        corr /= (noise.smooth(np.abs(fft2),half_win=20) ** 2 + 
-                   0.01 * np.mean(noise.smooth(np.abs(fft1),half_win=20),axis=1)[:,np.newaxis])
-    elif method == 'coherence':
-        corr /= (noise.smooth(np.abs(fft1),half_win=20)  + 
-                   0.01 * np.mean(noise.smooth(np.abs(fft1),half_win=20),axis=1)[:,np.newaxis])
-        corr /= (noise.smooth(np.abs(fft2),half_win=20)  + 
-                   0.01 * np.mean(noise.smooth(np.abs(fft2),half_win=20),axis=1)[:,np.newaxis])
-
-    corr = np.real(scipy.fftpack.ifft(corr, Nfft,axis=axis)) 
-    if axis == 1:
-        corr = np.concatenate((corr[:,-Nt//2 + 1:], corr[:,:Nt//2 + 1]),axis=axis)
-    else:
-        corr = np.concatenate((corr[-Nt//2 + 1:], corr[:Nt//2 + 1]),axis=axis)
 
- 
-    tcorr = np.arange(-Nt//2 + 1, Nt//2)
-    ind = np.where(np.abs(tcorr) <= maxlag)[0]
-    if axis == 1:
-        corr = corr[:,ind]
-    else:
-        corr = corr[ind]
+def fft_len(npts, maxlag):
+    """
+    FFT length for cross-correlating windows of npts samples up to maxlag samples.
 
-    return corr
+    Zero-padding to at least npts + maxlag keeps lags -maxlag..maxlag free
+    of circular wrap-around, so only those lags need to be kept afterwards.
+
+    :type npts: int
+    :param npts: number of samples in each window
+    :type maxlag: float
+    :param maxlag: maximum lag, in samples
+    :rtype: int
+    """
+    return next_fast_len(int(npts) + int(np.round(maxlag)), real=True)
+
+
+@dataclass(frozen=True, eq=False)
+class CorrelatePlan:
+    """ FFT length and lag indices used by `correlate`. """
+    Nfft: int
+    maxlag: int
+    ind: np.ndarray
+
+
+@lru_cache(maxsize=32)
+def correlate_plan(Nfft, maxlag):
+    """
+    Build the `CorrelatePlan` for an FFT length and maximum lag.
+
+    ind picks lags -maxlag..maxlag, in order, from the circular output of
+    the inverse FFT.
+
+    :type Nfft: int
+    :param Nfft: The number of points in the FFT
+    :type maxlag: int
+    :param maxlag: maximum lag, in samples
+    :rtype: `CorrelatePlan`
+    """
+    tcorr = np.arange(-Nfft // 2 + 1, Nfft // 2)
+    ind = tcorr[np.abs(tcorr) <= maxlag] % Nfft
+    ind.flags.writeable = False
+    return CorrelatePlan(Nfft, maxlag, ind)
 
 
-def whiten(data, delta, freqmin, freqmax, to_whiten=True, Nfft=None):
+def whiten(data, plan, to_whiten=True, engine='numpy'):
     """This function takes 1-dimensional *data* timeseries array,
-    goes to frequency domain using fft, whitens the amplitude of the spectrum
+    goes to frequency domain using a real fft, whitens the amplitude of the spectrum
     in frequency domain between *freqmin* and *freqmax*
-    and returns the whitened fft.
+    and returns the whitened fft of the positive frequencies (Nfft // 2 + 1 points).
 
     :type data: :class:`numpy.ndarray`
     :param data: Contains the 1D time series to whiten
-    :type Nfft: int
-    :param Nfft: The number of points to compute the FFT
-    :type delta: float
-    :param delta: The sampling frequency of the `data`
-    :type freqmin: float
-    :param freqmin: The lower frequency bound
-    :type freqmax: float
-    :param freqmax: The upper frequency bound
+    :type plan: `WhitenPlan`
+    :param plan: FFT length, frequency band and tapers, from `whiten_plan`
+    :type engine: str
+    :param engine: 'numpy', or 'cupy' to whiten on the GPU and return a cupy array
 
     :rtype: :class:`numpy.ndarray`
     :returns: The FFT of the input trace, whitened between the frequency bounds
     """
 
-    # Speed up FFT by padding to optimal size for FFTPACK
     if data.ndim == 1:
         axis = 0
     elif data.ndim == 2:
         axis = 1
 
-    if Nfft is None:
-        Nfft = next_fast_len(int(data.shape[axis]))
+    cp = _array_module(engine)
+    if cp is not np:
+        FFTRawSign = cp.fft.rfft(cp.asarray(data), plan.Nfft, axis=axis)
+        FFTRawSign = FFTRawSign.astype(cp.complex64, copy=False)
+        if to_whiten:
+            # taper, normalise and zero out-of-band bins in one pass
+            _whiten_kernel()(cp.asarray(plan.left_taper), cp.asarray(plan.right_taper),
+                             plan.low, plan.left, plan.right, plan.high,
+                             FFTRawSign.shape[axis], FFTRawSign)
+        return FFTRawSign
+
+    FFTRawSign = scipy.fft.rfft(data, plan.Nfft, axis=axis, workers=-1)
+
+    if to_whiten:
+        # Left tapering:
+        FFTRawSign[...,0:plan.low] *= 0
+        band = FFTRawSign[...,plan.low:plan.left]
+        np.multiply(band, plan.left_taper / _magnitude(band), out=band)
+        # Pass band:
+        band = FFTRawSign[...,plan.left:plan.right]
+        np.divide(band, _magnitude(band), out=band)
+        # Right tapering:
+        band = FFTRawSign[...,plan.right:plan.high]
+        np.multiply(band, plan.right_taper / _magnitude(band), out=band)
+        FFTRawSign[...,plan.high:] *= 0
 
+    return FFTRawSign
+
+
+@dataclass(frozen=True, eq=False)
+class WhitenPlan:
+    """ FFT length, band indices and cosine tapers used by `whiten`. """
+    Nfft: int
+    low: int
+    left: int
+    right: int
+    high: int
+    left_taper: np.ndarray
+    right_taper: np.ndarray
+
+
+@lru_cache(maxsize=32)
+def whiten_plan(Nfft, delta, freqmin, freqmax):
+    """
+    Build the `WhitenPlan` for an FFT length, sampling interval and band.
+
+    Depends only on these parameters, so the plan is computed once and
+    reused for every window.
+
+    :type Nfft: int
+    :param Nfft: The number of points in the FFT
+    :type delta: float
+    :param delta: The sampling interval of the data
+    :type freqmin: float
+    :param freqmin: The lower frequency bound
+    :type freqmax: float
+    :param freqmax: The upper frequency bound
+    :rtype: `WhitenPlan`
+    """
     pad = 100
-    Nfft = int(Nfft)
-    freqVec = scipy.fftpack.fftfreq(Nfft, d=delta)[:Nfft // 2]
+    freqVec = np.fft.rfftfreq(Nfft, d=delta)[:Nfft // 2]
 
     J = np.where((freqVec >= freqmin) & (freqVec <= freqmax))[0]
     low = J[0] - pad
@@ -494,83 +729,97 @@ def whiten(data, delta, freqmin, freqmax, to_whiten=True, Nfft=None):
     if high > Nfft / 2:
         high = int(Nfft // 2)
 
-    FFTRawSign = scipy.fftpack.fft(data, Nfft,axis=axis)
-
-    if to_whiten:
-
-        # Left tapering:
-        if axis == 1:
-            FFTRawSign[:,0:low] *= 0
-            FFTRawSign[:,low:left] = np.cos(
-                np.linspace(np.pi / 2., np.pi, left - low)) ** 2 * np.exp(
-                1j * np.angle(FFTRawSign[:,low:left]))
-            # Pass band:
-            FFTRawSign[:,left:right] = np.exp(1j * np.angle(FFTRawSign[:,left:right]))
-            # Right tapering:
-            FFTRawSign[:,right:high] = np.cos(
-                np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
-                1j * np.angle(FFTRawSign[:,right:high]))
-            FFTRawSign[:,high:Nfft + 1] *= 0
-
-            # Hermitian symmetry (because the input is real)
-            FFTRawSign[:,-(Nfft // 2) + 1:] = FFTRawSign[:,1:(Nfft // 2)].conjugate()[::-1]
-        else:
-            FFTRawSign[0:low] *= 0
-            FFTRawSign[low:left] = np.cos(
-                np.linspace(np.pi / 2., np.pi, left - low)) ** 2 * np.exp(
-                1j * np.angle(FFTRawSign[low:left]))
-            # Pass band:
-            FFTRawSign[left:right] = np.exp(1j * np.angle(FFTRawSign[left:right]))
-            # Right tapering:
-            FFTRawSign[right:high] = np.cos(
-                np.linspace(0., np.pi / 2., high - right)) ** 2 * np.exp(
-                1j * np.angle(FFTRawSign[right:high]))
-            FFTRawSign[high:Nfft + 1] *= 0
-
-            # Hermitian symmetry (because the input is real)
-            FFTRawSign[-(Nfft // 2) + 1:] = FFTRawSign[1:(Nfft // 2)].conjugate()[::-1]
-
-    return FFTRawSign
-
-def nearest_step(t1,t2,step):
-    step_min = step / 60
-    if t1 == t2:
-        return t1,t2
-
-    day1,hour1,minute1,second1 = t1.day,t1.hour,t1.minute,t1.second
-    day2,hour2,minute2,second2 = t2.day,t2.hour,t2.minute,t2.second
-
-    start1 = obspy.UTCDateTime(t1.year,t1.month,t1.day)
-    start2 = obspy.UTCDateTime(t2.year,t2.month,t2.day)
-
-    t1s = np.array([start1 + s for s in range(0,86400+step,step)])
-    t2s = np.array([start2 + s for s in range(0,86400+step,step)])
-    t1diff = [t - t1 for t in t1s]
-    t2diff = [t - t2 for t in t2s]
-    ind1 = np.argmin(np.abs(t1diff))
-    ind2 = np.argmin(np.abs(t2diff))
-    t1 = t1s[ind1]
-    t2 = t2s[ind2]
-
-    return t1,t2
+    left_taper = (np.cos(np.linspace(np.pi / 2., np.pi, left - low)) ** 2).astype(np.float32)
+    right_taper = (np.cos(np.linspace(0., np.pi / 2., high - right)) ** 2).astype(np.float32)
+    for arr in (left_taper, right_taper):
+        arr.flags.writeable = False
+    return WhitenPlan(Nfft, int(low), int(left), int(right), int(high),
+                      left_taper, right_taper)
+
+
+def _magnitude(fft):
+    """ Spectral amplitude, with empty bins left at zero instead of NaN. """
+    mag = np.abs(fft)
+    mag[mag == 0] = 1.
+    return mag
+
+
+def _array_module(engine):
+    """ numpy, or cupy for engine='cupy'. cupy is only imported when asked for. """
+    if engine == 'cupy':
+        import cupy
+        return cupy
+    elif engine != 'numpy':
+        raise ValueError('engine must be numpy or cupy, not {}'.format(engine))
+    return np
+
+
+def _smooth_box(xp, x, half_win):
+    """ `noise.smooth_box` for numpy or cupy arrays. """
+    if xp is np:
+        return noise.smooth_box(x, half_win=half_win)
+    if x.shape[-1] <= half_win:
+        raise ValueError('x must be longer than half_win')
+    window_len = 2 * half_win + 1
+    x_pad = xp.concatenate([x[..., half_win:0:-1], x, x[..., :-half_win - 1:-1]], axis=-1)
+    s = xp.cumsum(x_pad, axis=-1, dtype=xp.float64)
+    s = xp.concatenate([xp.zeros(s.shape[:-1] + (1,)), s], axis=-1)
+    return ((s[..., window_len:] - s[..., :-window_len]) / window_len).astype(x.dtype)
+
+
+@lru_cache(maxsize=1)
+def _whiten_kernel():
+    """ cupy kernel applying a `WhitenPlan` in place to complex64 spectra. """
+    import cupy
+    return cupy.ElementwiseKernel(
+        'raw float32 left_taper, raw float32 right_taper, int64 low, int64 left, '
+        'int64 right, int64 high, int64 nf',
+        'complex64 z',
+        '''
+        const long long k = i % nf;
+        const float mag = abs(z);
+        if (k < low || k >= high || mag == 0) {
+            z = complex<float>(0, 0);
+        } else if (k < left) {
+            z = z * (left_taper[k - low] / mag);
+        } else if (k < right) {
+            z = z / mag;
+        } else {
+            z = z * (right_taper[k - right] / mag);
+        }
+        ''',
+        'noise_whiten')
+
+def _round_to_step(t,step):
+    """ Round t to the nearest multiple of step seconds since its day started, ties down. """
+    ts = t.timestamp
+    day0 = ts - ts % 86400
+    n = np.ceil((ts - day0) / step - 0.5)
+    return obspy.UTCDateTime(day0 + n * step)
 
 def filter_dist(pairs,locs,min_dist,max_dist):
     """
 
     Filter station pairs by distance
 
+    Distances are great-circle (haversine) distances, in km, on a sphere of
+    radius 6371 km, computed for all pairs at once.
     """
-    new_pairs = []
-    for pair in pairs:
-        netsta1 = '.'.join(pair[0].split('/')[-3:-1])
-        netsta2 = '.'.join(pair[1].split('/')[-3:-1])
-
-        dist,azi,baz = noise.calc_distance(locs.loc[netsta1],locs.loc[netsta2])
+    if len(pairs) == 0:
+        return []
+    netsta1 = ['.'.join(pair[0].split('/')[-3:-1]) for pair in pairs]
+    netsta2 = ['.'.join(pair[1].split('/')[-3:-1]) for pair in pairs]
+    lat1 = np.radians(locs.loc[netsta1,'latitude'].to_numpy(dtype=np.float64))
+    lon1 = np.radians(locs.loc[netsta1,'longitude'].to_numpy(dtype=np.float64))
+    lat2 = np.radians(locs.loc[netsta2,'latitude'].to_numpy(dtype=np.float64))
+    lon2 = np.radians(locs.loc[netsta2,'longitude'].to_numpy(dtype=np.float64))
 
-        if (dist > min_dist) and (dist < max_dist):
-            new_pairs.append(pair)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + \
+        np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    dist = 2 * 6371. * np.arcsin(np.sqrt(a))
 
-    return new_pairs
+    keep = np.where((dist > min_dist) & (dist < max_dist))[0]
+    return [pairs[ii] for ii in keep]
 
 
 def station_list(station):
@@ -584,8 +833,8 @@ def station_list(station):
     df = pd.DataFrame(clse_split,columns=['CHAN','LOC','START','END'])
     df = df.drop(columns='LOC')
     df['FILES'] = files
-    df['START'] = pd.to_datetime(df['START'].apply(lambda x: x.split('T')[0]))
-    df['END'] = pd.to_datetime(df['END'].apply(lambda x: x.split('T')[0]))
+    df['START'] = pd.to_datetime(df['START'], format='%Y%m%dT%H%M%SZ', utc=True)
+    df['END'] = pd.to_datetime(df['END'], format='%Y%m%dT%H%M%SZ', utc=True)
     df = df.set_index('START')
     return df
 
@@ -603,5 +852,156 @@ def xyz_to_zne(st):
     return st
 
 
+def station_locs(XML):
+    """
+
+    Create dataframe with latitude, longitude and elevation_in_m for each
+    station, indexed by net.sta, from a directory of net.sta.xml files.
+    """
+    locs = {}
+    for xml in glob.glob(os.path.join(XML,'*.xml')):
+        sta = read_inventory(xml, format="STATIONXML")[0][0]
+        netsta = os.path.basename(xml).replace('.xml','')
+        locs[netsta] = {'latitude':sta.latitude,
+                        'longitude':sta.longitude,
+                        'elevation_in_m':sta.elevation}
+    return pd.DataFrame.from_dict(locs,orient='index')
+
+def read_streams(files):
+    """
+    Read mseed files one at a time, yielding an empty stream for unreadable files.
+    """
+    for f in files:
+        try:
+            yield obspy.read(f)
+        except Exception as e:
+            print('{}: {}'.format(f,e))
+            yield obspy.Stream()
+
+def run_pairs(files,corr_dir,maxlag,downsamp_freq,freqmin,freqmax,XML,locs,
+              min_dist=0.,max_dist=20000.,step=1800,cc_len=3600,
+              method='cross_correlation',time_norm='running_mean',stack=False,
+              max_std=50.,compression='lzf',engine='numpy'):
+    """
+
+    Cross-correlate all station pairs, split over MPI ranks.
+
+    Files starting on the same day at different stations are paired, and
+    the source stations are dealt round-robin to the ranks. Each source
+    file is whitened once and cross-correlated against all of its
+    receivers with `main_one_to_many`. Each station pair is written to its
+    own ASDF file, {corr_dir}/net_sta_net_sta.h5, by the one rank that owns
+    its source station, so ranks never write to the same file. Pairs that
+    fail to cross-correlate are reported and skipped, and no file is
+    written for a station pair without any cross-correlation.
+
+    :type files: list
+    :param files: mseed files as path/to/NET/STA/CHAN.LOC.START.END.mseed
+    :type corr_dir: str
+    :param corr_dir: directory to write cross-correlation HDF5 files
+    :type locs: `~pandas.DataFrame`
+    :param locs: latitude, elevation_in_m, and longitude of all stations
+    :type min_dist: float 
+    :param min_dist: minimum distance between stations in km 
+    :type max_dist: float 
+    :param max_dist: maximum distance between stations in km 
+    :type compression: str
+    :param compression: HDF5 compression of written cross-correlations, any value
+                        accepted by `pyasdf.ASDFDataSet`, e.g. 'lzf', 'gzip-3' or None
+    :return: sorted list of written files on rank 0, None on other ranks
+
+    See `main` for the remaining parameters.
+    """
+    comm = MPI.COMM_WORLD
+    rank, size = comm.Get_rank(), comm.Get_size()
+
+    # pair each file with the files of later stations that start on the same day
+    days = {}
+    for f in sorted(files):
+        days.setdefault(os.path.basename(f).split('.')[2],[]).append(f)
+    pairs = []
+    for day_files in days.values():
+        for pair in itertools.combinations(day_files,2):
+            if os.path.dirname(pair[0]) != os.path.dirname(pair[1]):
+                pairs.append(pair)
+    pairs = filter_dist(pairs,locs,min_dist,max_dist)
+
+    # group receivers by source file and deal source stations to ranks. A
+    # station pair always has the same source station, so only one rank
+    # writes to each station pair's file.
+    receivers = {}
+    for source,receiver in pairs:
+        receivers.setdefault(source,[]).append(receiver)
+    stations = sorted({os.path.dirname(source) for source in receivers})
+    my_stations = set(stations[rank::size])
+    my_sources = [source for source in sorted(receivers) if os.path.dirname(source) in my_stations]
+
+    written = set()
+    for source in my_sources:
+        # a bad file must not take down this rank, the others wait for it in gather
+        try:
+            results = main_one_to_many(obspy.read(source),read_streams(receivers[source]),
+                                       maxlag,downsamp_freq,freqmin,freqmax,XML,step=step,
+                                       cc_len=cc_len,method=method,time_norm=time_norm,
+                                       stack=stack,max_std=max_std,engine=engine)
+            # write each cross-correlation as it arrives
+            for receiver,result in zip(receivers[source],results):
+                if isinstance(result,Exception):
+                    print('{} {}: {}'.format(source,receiver,result))
+                    continue
+                net_sta = '_'.join(['_'.join(p.split('/')[-3:-1]) for p in (source,receiver)])
+                corr_h5 = os.path.join(corr_dir,net_sta + '.h5')
+                try:
+                    corr,t_cc,source_stats,receiver_stats,source_params,receiver_params = result
+                    parameters = cross_corr_parameters(source_stats,receiver_stats,t_cc,
+                                         source_params,receiver_params,locs,maxlag)
+                    comp = source_stats.channel[-1] + receiver_stats.channel[-1]
+                    day = obspy.UTCDateTime(t_cc[0,0]).strftime('%Y_%m_%d')
+                    path = '/'.join([net_sta,comp,'_'.join(['corr',day])])
+                    # files are only created once there is a cross-correlation to write
+                    with pyasdf.ASDFDataSet(corr_h5,compression=compression,mpi=False) as ds:
+                        ds.add_auxiliary_data(data=corr,
+                                              data_type='CrossCorrelation',
+                                              path=path,
+                                              parameters=parameters)
+                except Exception as e:
+                    print('{} {}: {}'.format(source,receiver,e))
+                    continue
+                written.add(corr_h5)
+        except Exception as e:
+            print('{}: {}'.format(source,e))
+
+    # rank 0 owns aggregation
+    written = comm.gather(written,root=0)
+    if rank == 0:
+        return sorted(itertools.chain.from_iterable(written))
+
+
 if __name__ == "__main__":
-    pass
+    # mpirun -n N python compute_cc.py DATA XML CORR [--maxlag 100 ...]
+    # DATA is laid out as DATA/NET/STA/CHAN.LOC.START.END.mseed
+    parser = argparse.ArgumentParser(description='Cross-correlate all station pairs in DATA.')
+    parser.add_argument('DATA', help='directory of NET/STA/CHAN.LOC.START.END.mseed files')
+    parser.add_argument('XML', help='directory of net.sta.xml StationXML files')
+    parser.add_argument('CORR', help='output directory for cross-correlation HDF5 files')
+    parser.add_argument('--maxlag', type=int, default=100, help='maximum lag, in seconds')
+    parser.add_argument('--downsamp_freq', type=float, default=20.,
+                        help='sampling rate, in Hz, to downsample to')
+    parser.add_argument('--freqmin', type=float, default=0.05, help='lower whitening frequency, in Hz')
+    parser.add_argument('--freqmax', type=float, default=5., help='upper whitening frequency, in Hz')
+    parser.add_argument('--step', type=float, default=1800., help='seconds between windows')
+    parser.add_argument('--cc_len', type=float, default=3600., help='window length, in seconds')
+    args = parser.parse_args()
+
+    comm = MPI.COMM_WORLD
+    if comm.Get_rank() == 0 and not os.path.isdir(args.CORR):
+        os.makedirs(args.CORR)
+    comm.Barrier()
+
+    files = glob.glob(os.path.join(args.DATA,'*','*','*.mseed'))
+    locs = station_locs(args.XML)
+    written = run_pairs(files,args.CORR,maxlag=args.maxlag,downsamp_freq=args.downsamp_freq,
+                        freqmin=args.freqmin,freqmax=args.freqmax,XML=args.XML,locs=locs,
+                        step=args.step,cc_len=args.cc_len)
+    if written is not None:
+        print('Cross-correlated {} station pairs'.format(len(written)))
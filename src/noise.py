@@ -14,10 +14,12 @@ import glob
 import os
 
 import numpy as np 
-from scipy.fftpack import fft,ifft,next_fast_len
+import scipy.fft
+from scipy.fft import next_fast_len
 import scipy.signal 
 from scipy.signal import hilbert
 from scipy.ndimage import map_coordinates
+from numba import njit, prange
 
 import obspy 
 from obspy.signal.filter import bandpass
@@ -52,13 +54,13 @@ def snr(data,sampling_rate):
 
 def smooth(x, window='boxcar', half_win=3):
     """ some window smoothing from MSnoise MWCS """
+    if window == "boxcar":
+        return smooth_box(x, half_win)
+
     window_len = 2*half_win+1
     # extending the data at beginning and at the end
     # to apply the window at the borders
-    if window == "boxcar":
-        w = scipy.signal.boxcar(window_len).astype(x.dtype)
-    else:
-        w = scipy.signal.hanning(window_len).astype(x.dtype)
+    w = scipy.signal.hanning(window_len).astype(x.dtype)
 
     if x.ndim ==1:
         s = np.r_[x[window_len-1:0:-1], x, x[-1:-window_len:-1]]
@@ -73,6 +75,52 @@ def smooth(x, window='boxcar', half_win=3):
     return y
 
 
+def smooth_box(x, half_win=3):
+    """
+    Boxcar smoothing of 1-D array or rows of 2-D array.
+
+    Same result as the convolution in `smooth` with window='boxcar', but
+    computed as a rolling sum in O(len(x)). Edges are padded the same way:
+    the start is reflected about the first sample and the end is mirrored
+    including the last sample.
+
+    :type x:`~numpy.ndarray` 
+    :type half_win: int
+    :param half_win: Half-width of boxcar, window length is 2*half_win+1
+    :returns: Smoothed array
+    """
+    if x.shape[-1] <= half_win:
+        raise ValueError('x must be longer than half_win')
+    if x.ndim == 1:
+        return _smooth_box(x[np.newaxis, :], half_win)[0]
+    return _smooth_box(x, half_win)
+
+
+@njit
+def _reflect(k, n):
+    if k < 0:
+        return -k
+    elif k >= n:
+        return 2 * n - 1 - k
+    return k
+
+
+@njit(parallel=True)
+def _smooth_box(x, half_win):
+    M, n = x.shape
+    window_len = 2 * half_win + 1
+    y = np.empty_like(x)
+    for ii in prange(M):
+        s = 0.
+        for k in range(-half_win, half_win + 1):
+            s += x[ii, _reflect(k, n)]
+        y[ii, 0] = s / window_len
+        for jj in range(1, n):
+            s += x[ii, _reflect(jj + half_win, n)] - x[ii, _reflect(jj - half_win - 1, n)]
+            y[ii, jj] = s / window_len
+    return y
+
+
 def nextpow2(x):
     """
     Returns the next power of 2 of x.
@@ -112,12 +160,33 @@ def running_abs_mean(x, N):
     """
     ndim = x.ndim 
     if ndim == 1:
-        weights = np.convolve(np.abs(x), np.ones((N, )) / N)[(N - 1):]
-        x = x / weights 
+        x = _running_abs_mean(x[np.newaxis, :].astype(np.float64), N)[0]
     elif ndim == 2:
-        for ii in range(x.shape[0]):
-            weights = np.convolve(np.abs(x[ii, :]), np.ones((N, )) / N)[(N - 1):]
-            x[ii, :] = x[ii, :] / weights
+        x = _running_abs_mean(x, N)
+    return x
+
+
+@njit(parallel=True)
+def _running_abs_mean(x, N):
+    """
+    In-place kernel for `running_abs_mean` on a 2-D array.
+
+    Each sample is divided by the mean absolute value of the N samples
+    starting at it, kept as a rolling sum so each row costs O(Nt). Zero
+    samples are left at zero, so zero-padded gaps don't become 0/0 = NaN.
+    """
+    M, Nt = x.shape
+    for ii in prange(M):
+        s = 0.
+        for jj in range(min(N, Nt)):
+            s += abs(x[ii, jj])
+        for jj in range(Nt):
+            a = abs(x[ii, jj])
+            if a != 0.:
+                x[ii, jj] = x[ii, jj] / (s / N)
+            s -= a
+            if jj + N < Nt:
+                s += abs(x[ii, jj + N])
     return x
 
 def abs_max(arr):
@@ -373,9 +442,8 @@ def remove_small_traces(stream,min_length = 100.):
     if len(stream.get_gaps()) == 0:
         return stream
 
-    for tr in stream:
-        if tr.stats.npts < 4 * min_length*tr.stats.sampling_rate:
-            stream.remove(tr)
+    stream.traces = [tr for tr in stream 
+                     if tr.stats.npts >= 4 * min_length*tr.stats.sampling_rate]
     return stream	
 
 
@@ -403,10 +471,10 @@ def check_and_phase_shift(trace):
         trace.taper(taper_1s)
 
         n = int(2**nextpow2(len(trace.data)))
-        FFTdata = scipy.fftpack.fft(trace.data, n=n)
-        fftfreq = scipy.fftpack.fftfreq(n, d=trace.stats.delta)
-        FFTdata = FFTdata * np.exp(1j * 2. * np.pi * fftfreq * dt)
-        trace.data = np.real(scipy.fftpack.ifft(FFTdata, n=n)[:len(trace.data)])
+        FFTdata = scipy.fft.fft(trace.data, n=n, workers=-1)
+        fftfreq = np.fft.fftfreq(n, d=trace.stats.delta)
+        FFTdata *= np.exp(1j * 2. * np.pi * fftfreq * dt)
+        trace.data = np.real(scipy.fft.ifft(FFTdata, n=n, workers=-1, overwrite_x=True)[:len(trace.data)])
         trace.stats.starttime += dt
         return trace
     else:
@@ -459,9 +527,7 @@ def check_sample(stream):
             freqs.append(tr.stats.sampling_rate)
 
     freq = max(set(freqs),key=freqs.count)
-    for tr in stream:
-        if tr.stats.sampling_rate != freq:
-            stream.remove(tr)
+    stream.traces = [tr for tr in stream if tr.stats.sampling_rate == freq]
 
     return stream	
 
@@ -483,12 +549,10 @@ def check_length(stream):
     npts = np.array(npts)
     if len(npts) == 0:
         return stream	
-    index = np.where(npts != pts)
-    index = list(index[0])[::-1]
+    index = np.where(npts == pts)[0]
 
     # remove short traces
-    for trace in index:
-        stream.pop(trace)
+    stream.traces = [stream.traces[ii] for ii in index]
 
     return stream				
 
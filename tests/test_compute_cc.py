@@ -0,0 +1,235 @@
+import os
+import sys
+
+import numpy as np
+import obspy
+import pandas as pd
+import scipy.signal
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import compute_cc
+
+
+def synthetic_pair(lag=40, sampling_rate=20., hours=4, seed=0):
+    """ Source and receiver streams, the receiver delayed by lag samples. """
+    rng = np.random.default_rng(seed)
+    npts = int(hours * 3600 * sampling_rate)
+    data = rng.standard_normal(npts + lag)
+    starttime = obspy.UTCDateTime(2017, 1, 13)
+    source = obspy.Trace(data[lag:].copy(), header={'network': 'XX', 'station': 'A',
+                         'channel': 'BHZ', 'sampling_rate': sampling_rate,
+                         'starttime': starttime})
+    receiver = obspy.Trace(data[:npts] + 0.1 * rng.standard_normal(npts),
+                           header={'network': 'XX', 'station': 'B', 'channel': 'BHZ',
+                                   'sampling_rate': sampling_rate, 'starttime': starttime})
+    return obspy.Stream([source]), obspy.Stream([receiver])
+
+
+def test_round_to_step():
+    day = obspy.UTCDateTime(2017, 1, 13)
+    for seconds, expected in [(0., 0.), (899.9, 0.), (900., 0.), (900.1, 1800.),
+                              (86399., 86400.)]:
+        assert compute_cc._round_to_step(day + seconds, 1800) == day + expected
+
+
+def test_hann_taper():
+    for npts in [72000, 1000, 801]:
+        tr = obspy.Trace(np.ones(npts), header={'delta': 0.05})
+        tr.taper(max_percentage=0.05, max_length=20.)
+        assert np.allclose(compute_cc.hann_taper(npts, 0.05), tr.data, rtol=0, atol=1e-12)
+
+
+def test_whiten_engine():
+    data = np.zeros((2, 1000), dtype=np.float32)
+    plan = compute_cc.whiten_plan(1024, 0.05, 0.05, 5.)
+    with pytest.raises(ValueError):
+        compute_cc.whiten(data, plan, engine='Cupy')
+
+
+def test_cupy_engine():
+    cp = pytest.importorskip('cupy')
+    try:
+        cp.cuda.runtime.getDeviceCount()
+    except cp.cuda.runtime.CUDARuntimeError:
+        pytest.skip('no CUDA device')
+    data = np.random.default_rng(3).standard_normal((3, 72000))
+    plan = compute_cc.whiten_plan(74000, 0.05, 0.05, 5.)
+    for to_whiten in [True, False]:
+        white = compute_cc.whiten(data.astype(np.float32), plan, to_whiten=to_whiten)
+        white_gpu = compute_cc.whiten(data.astype(np.float32), plan, to_whiten=to_whiten,
+                                      engine='cupy')
+        assert isinstance(white_gpu, cp.ndarray)
+        assert np.allclose(cp.asnumpy(white_gpu), white, rtol=1e-3, atol=1e-4 * np.abs(white).max())
+    white, params = compute_cc.process_cc(data, 0.05, 0.05, 5., Nfft=74000)
+    white_gpu, params_gpu = compute_cc.process_cc(data, 0.05, 0.05, 5., Nfft=74000, engine='cupy')
+    assert np.allclose(cp.asnumpy(white_gpu), white, rtol=1e-3, atol=1e-4)
+    assert np.array_equal(params_gpu, params)
+    for method in ['cross_correlation', 'deconv', 'coherence']:
+        corr = compute_cc.correlate(white, white[[1, 2, 0]], 200, Nfft=74000, method=method)
+        corr_gpu = compute_cc.correlate(white_gpu, white_gpu[[1, 2, 0]], 200, Nfft=74000,
+                                        method=method, engine='cupy')
+        assert np.allclose(corr_gpu, corr, rtol=1e-3, atol=1e-4 * np.abs(corr).max())
+
+
+def test_process_cc():
+    data = np.random.default_rng(1).standard_normal((3, 72000))
+    white, params = compute_cc.process_cc(data, 0.05, 0.05, 5., time_norm='running_mean',
+                                          Nfft=74000)
+    assert white.shape == (3, 74000 // 2 + 1)
+    assert white.dtype == np.complex64
+    assert params.shape == (3, 3)
+    assert np.all(np.isfinite(white))
+
+
+def test_bandpass_sos_nyquist():
+    # freqmax at Nyquist falls back to a highpass, as obspy's bandpass does
+    with pytest.warns(UserWarning):
+        sos = compute_cc.bandpass_sos(0.05, 10., 0.05)
+    expected = obspy.signal.filter.highpass(np.eye(1, 2000, 1000)[0], 0.05, 20.,
+                                            corners=4, zerophase=True)
+    response = scipy.signal.sosfiltfilt(sos, np.eye(1, 2000, 1000)[0])
+    assert np.allclose(response, expected, atol=1e-4)
+
+
+def test_whiten_rows_independent():
+    # the full-spectrum whiten mirrored 2-D spectra across rows instead of
+    # frequencies, so each window's output depended on the others
+    data = np.random.default_rng(2).standard_normal((3, 2000)).astype(np.float32)
+    plan = compute_cc.whiten_plan(2048, 0.05, 0.05, 5.)
+    white = compute_cc.whiten(data, plan)
+    for row, white_row in zip(data, white):
+        assert np.allclose(compute_cc.whiten(row, plan), white_row)
+
+
+def test_main():
+    source, receiver = synthetic_pair()
+    maxlag, fs = 10, 20.
+    corr, t_cc, _, _, source_params, receiver_params = compute_cc.main(
+        source, receiver, maxlag, fs, 0.05, 5., None, step=1800, cc_len=3600)
+    assert corr.shape == (len(t_cc), 2 * int(maxlag * fs) + 1)
+    assert len(source_params) == len(receiver_params) == len(t_cc)
+    assert np.allclose(t_cc[:, 1] - t_cc[:, 0], 3600)
+    # the delay between the stations shows up as a peak 40 samples off zero lag
+    peak = np.argmax(np.abs(corr), axis=1) - int(maxlag * fs)
+    assert np.all(np.abs(peak) == 40)
+
+
+def test_main_freqmax_nyquist():
+    source, receiver = synthetic_pair()
+    corr, *_ = compute_cc.main(source, receiver, 10, 20., 0.05, 10., None)
+    peak = np.argmax(np.abs(corr), axis=1) - 200
+    assert np.all(np.abs(peak) == 40)
+
+
+def test_main_stack():
+    source, receiver = synthetic_pair()
+    corr, t_cc, _, _, _, _ = compute_cc.main(source, receiver, 10, 20., 0.05, 5., None,
+                                             step=1800, cc_len=3600, stack=True)
+    assert corr.shape == (401,)
+    assert abs(np.argmax(np.abs(corr)) - 200) == 40
+
+
+def test_main_stack_max_std():
+    source, receiver = synthetic_pair()
+    # an earthquake in the windows starting at 1800 s and 3600 s
+    source[0].data[int(5000 * 20)] = 1e4
+    _, t_all, _, _, _, _ = compute_cc.main(source.copy(), receiver.copy(), 10, 20., 0.05, 5., None)
+    corr, t_cc, _, _, source_params, receiver_params = compute_cc.main(
+        source, receiver, 10, 20., 0.05, 5., None, stack=True, max_std=50.)
+    assert corr.ndim == 1
+    assert len(t_cc) == len(t_all) - 2
+    assert not np.any(np.isin(t_cc[:, 0] - t_all[0, 0], [1800, 3600]))
+    assert np.all(source_params[:, 1] < 50.) and len(receiver_params) == len(t_cc)
+
+
+def test_main_one_to_many():
+    source, receiver = synthetic_pair()
+    _, other = synthetic_pair(lag=20, seed=1)
+    args = (10, 20., 0.05, 5., None)
+    results = list(compute_cc.main_one_to_many(source.copy(), [receiver.copy(), obspy.Stream(),
+                                               other.copy()], *args, method='deconv'))
+    assert isinstance(results[1], Exception)
+    for result, rec in zip(results[::2], [receiver, other]):
+        expected = compute_cc.main(source.copy(), rec.copy(), *args, method='deconv')
+        assert np.allclose(result[0], expected[0], atol=1e-6)
+        assert np.array_equal(result[1], expected[1])
+        assert np.array_equal(result[5], expected[5])
+
+
+def test_main_raises_receiver_error():
+    source, _ = synthetic_pair()
+    with pytest.raises(Exception) as e:
+        compute_cc.main(source.copy(), obspy.Stream(), 10, 20., 0.05, 5., None)
+    error = next(compute_cc.main_one_to_many(source, [obspy.Stream()], 10, 20., 0.05, 5., None))
+    assert type(e.value) is type(error) and str(e.value) == str(error)
+    assert str(e.value) != 'No data cross-correlated'
+
+
+def test_run_pairs(tmp_path):
+    source, receiver = synthetic_pair()
+    name = 'BHZ.00.20170113T000000Z.20170114T000000Z.mseed'
+    for st in (source, receiver):
+        os.makedirs(tmp_path / 'XX' / st[0].stats.station)
+        st.write(str(tmp_path / 'XX' / st[0].stats.station / name), format='MSEED')
+    # unreadable file, its station pairs are skipped without creating files
+    os.makedirs(tmp_path / 'XX' / 'C')
+    (tmp_path / 'XX' / 'C' / name).write_text('not mseed')
+    files = [str(f) for f in tmp_path.glob('*/*/*.mseed')]
+    locs = pd.DataFrame({'latitude': [0., 0., 0.], 'longitude': [0., 0.1, 0.2],
+                         'elevation_in_m': [0., 0., 0.]}, index=['XX.A', 'XX.B', 'XX.C'])
+    corr_dir = tmp_path / 'CORR'
+    os.makedirs(corr_dir)
+
+    written = compute_cc.run_pairs(files, str(corr_dir), 10, 20., 0.05, 5., None, locs)
+    assert written == [str(corr_dir / 'XX_A_XX_B.h5')]
+    assert sorted(os.listdir(corr_dir)) == ['XX_A_XX_B.h5']
+
+
+def test_filter_dist():
+    locs = pd.DataFrame({'latitude': [0., 0., 0.], 'longitude': [0., 1., 2.]},
+                        index=['XX.A', 'XX.B', 'XX.C'])
+    pairs = [('DATA/XX/A/f.mseed', 'DATA/XX/B/f.mseed'),
+             ('DATA/XX/A/f.mseed', 'DATA/XX/C/f.mseed'),
+             ('DATA/XX/B/f.mseed', 'DATA/XX/C/f.mseed')]
+    # one degree is 111.19 km on the 6371 km sphere, 111.32 km on the WGS84 equator
+    assert compute_cc.filter_dist(pairs, locs, 100., 111.25) == [pairs[0], pairs[2]]
+    assert compute_cc.filter_dist(pairs, locs, 111.25, 20000.) == [pairs[1]]
+    assert compute_cc.filter_dist([], locs, 0., 20000.) == []
+
+
+def test_station_list(tmp_path):
+    names = ['BHZ.00.20170114T000000Z.20170115T000000Z.mseed',
+             'BHE.00.20170113T000000Z.20170114T000000Z.mseed']
+    os.makedirs(tmp_path / '2017')
+    for name in names:
+        (tmp_path / '2017' / name).write_text('')
+    df = compute_cc.station_list(str(tmp_path)).sort_index()
+    assert list(df.index) == [pd.Timestamp('2017-01-13', tz='UTC'),
+                              pd.Timestamp('2017-01-14', tz='UTC')]
+    assert list(df['END']) == [pd.Timestamp('2017-01-14', tz='UTC'),
+                               pd.Timestamp('2017-01-15', tz='UTC')]
+    assert list(df['CHAN']) == ['BHE', 'BHZ']
+    assert [os.path.basename(f) for f in df['FILES']] == names[::-1]
+
+
+def test_mseed_data(tmp_path):
+    days = ['20170113T000000Z', '20170114T000000Z', '20170115T000000Z', '20170116T000000Z']
+    for start, end in zip(days[:-1], days[1:]):
+        (tmp_path / 'BHZ.00.{}.{}.mseed'.format(start, end)).write_text('')
+    t = obspy.UTCDateTime
+    for starttime, endtime in [(None, None),
+                               (t('2017-01-13T00:00:00.5'), None),
+                               (t('2017-01-12T23:59:59.5'), None),
+                               (t('2017-01-14T00:00:00'), None),
+                               (None, t('2017-01-15T00:00:00.5')),
+                               (None, t('2017-01-14T23:59:59.9')),
+                               (t('2017-01-13T00:00:00.5'), t('2017-01-16T00:00:00'))]:
+        mseed, start, end = compute_cc.mseed_data(str(tmp_path), starttime, endtime)
+        # same selection as comparing the times as UTCDateTime
+        expected = [(t(s), t(e)) for s, e in zip(days[:-1], days[1:])
+                    if (starttime is None or t(s) >= starttime) and
+                    (endtime is None or t(e) <= endtime)]
+        assert list(zip(start, end)) == expected
+        assert [os.path.basename(m).split('.')[2] for m in mseed] == \
+            [s.strftime('%Y%m%dT%H%M%SZ') for s, _ in expected]
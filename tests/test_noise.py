@@ -0,0 +1,39 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import noise
+
+
+def test_running_abs_mean():
+    rng = np.random.default_rng(0)
+    N = 10
+    x = np.vstack([rng.standard_normal(150), np.r_[rng.standard_normal(100), np.zeros(50)]])
+    with np.errstate(invalid='ignore'):
+        expected = np.array([row / np.convolve(np.abs(row), np.ones(N) / N)[N - 1:]
+                             for row in x])[:, :100]
+    y = noise.running_abs_mean(x.copy(), N)
+    assert np.allclose(y[:, :100], expected)
+    # zero-padded gaps stay zero instead of 0/0
+    assert np.all(y[1, 100:] == 0)
+    assert np.allclose(noise.running_abs_mean(x[0].copy(), N)[:100], expected[0])
+
+
+def test_smooth_box():
+    # reference: the convolution smooth used before smooth_box
+    def convolve_smooth(x, half_win):
+        window_len = 2 * half_win + 1
+        s = np.r_[x[window_len - 1:0:-1], x, x[-1:-window_len:-1]]
+        y = np.convolve(np.ones(window_len) / window_len, s, mode='valid')
+        return y[half_win:len(y) - half_win]
+
+    x = np.random.default_rng(1).standard_normal((2, 300))
+    for half_win in [3, 20]:
+        expected = np.array([convolve_smooth(row, half_win) for row in x])
+        assert np.allclose(noise.smooth_box(x, half_win), expected)
+        assert np.allclose(noise.smooth(x[0], half_win=half_win), expected[0])
+    with pytest.raises(ValueError):
+        noise.smooth_box(x[:, :20], half_win=20)